@@ -1,4 +1,7 @@
-#!/usr/bin/python
+#!/usr/bin/python3
+
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.httpserver
 import tornado.websocket
@@ -10,51 +13,74 @@ import RPi.GPIO as GPIO
 
 define("port", default=8080, help="run on the given port", type=int)
 
+LEDS = {"red": 22, "yellow": 27, "green": 17}
+
+# Blocking GPIO calls run here, a single worker keeps them in order.
+GPIO_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+
+
+def toggle(colors):
+    for color in colors:
+        if color in LEDS:
+            pin = LEDS[color]
+            GPIO.output(pin, 1 - GPIO.input(pin))
+
+    return ('{ "red": ' + str(GPIO.input(22)) + ', "yellow": ' +
+            str(GPIO.input(27)) + ', "green": ' +
+            str(GPIO.input(17)) + ' }')
+
 
 class IndexHandler(tornado.web.RequestHandler):
     def get(self):
+        self.set_header("Cache-Control", "no-cache")
         self.render("index.html")
 
 
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
+    def get_compression_options(self):
+        return {'compression_level': 6, 'mem_level': 4}
+
     def open(self):
         print('New connection was opened')
 
-    def on_message(self, message):
+    async def on_message(self, message):
         print('Incoming message: ' + message)
+        colors = list()
         for color in message.split('\n'):
             color = color.lower().strip()
             print(color)
-            if (color == "red"):
-                GPIO.output(22, 1 - GPIO.input(22))
+            colors.append(color)
 
-            if (color == "yellow"):
-                GPIO.output(27, 1 - GPIO.input(27))
-
-            if (color == "green"):
-                GPIO.output(17, 1 - GPIO.input(17))
-
-        self.write_message('{ "red": ' + str(GPIO.input(22)) + ', "yellow": ' +
-                           str(GPIO.input(27)) + ', "green": ' +
-                           str(GPIO.input(17)) + ' }')
+        status = await tornado.ioloop.IOLoop.current().run_in_executor(GPIO_EXECUTOR, toggle, colors)
+        try:
+            await self.write_message(status)
+        except tornado.websocket.WebSocketClosedError:
+            pass
 
     def on_close(self):
-        print 'Connection was closed...'
+        print('Connection was closed...')
 
 
-APP = tornado.web.Application(handlers=[ (r"/", IndexHandler),
-                                                 (r"/ws", WebSocketHandler)],
-                                      autoreload=True)
+def make_app():
+    return tornado.web.Application(handlers=[(r"/", IndexHandler),
+                                             (r"/ws", WebSocketHandler)],
+                                   compress_response=True,
+                                   autoreload=True)
 
-if __name__ == "__main__":
+
+async def main():
+    tornado.options.parse_command_line()
 
     GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
-    GPIO.setup(17, GPIO.OUT)
-    GPIO.setup(22, GPIO.OUT)
-    GPIO.setup(27, GPIO.OUT)
+    for pin in LEDS.values():
+        GPIO.setup(pin, GPIO.OUT)
 
-    http_server = tornado.httpserver.HTTPServer(APP)
+    http_server = tornado.httpserver.HTTPServer(make_app())
     http_server.listen(options.port)
     print("Listening on port: " + str(options.port))
-    tornado.ioloop.IOLoop.instance().start()
+    await asyncio.Event().wait()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 from RPi import GPIO
 import time
@@ -51,7 +51,7 @@ while True:
        sensor = GPIO.input(26)
        #Sensor 0 is dark, sensor 1 is light
        if sensor == 1:
-	   if direction != 1:
+           if direction != 1:
                print("Going straight")
            direction = 1
            #Go slightly left
@@ -67,14 +67,14 @@ while True:
                motor_l.ChangeDutyCycle(5)
                motor_r.ChangeDutyCycle(65)
                r_count += 1
-	   else:
+           else:
                if direction != 3:
                    print("Going left")
                direction = 3
                #Go left
                motor_l.ChangeDutyCycle(80)
                motor_r.ChangeDutyCycle(10)
-       
+
        time.sleep(0.01)
 
        #Get the stop button state
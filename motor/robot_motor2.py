@@ -1,4 +1,4 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
 from RPi import GPIO
 import time
@@ -61,7 +61,7 @@ while True:
        sensor = GPIO.input(26)
        #Sensor 0 is dark, sensor 1 is light
        if sensor == 1:
-	   if direction != 1:
+           if direction != 1:
                print("Going left")
            direction = 1
            #Go slightly left
@@ -74,7 +74,7 @@ while True:
            #Go right
            motor_l.ChangeDutyCycle(7)
            motor_r.ChangeDutyCycle(speed)
-       
+
        #time.sleep(0.01)
 
        #Get the stop button state
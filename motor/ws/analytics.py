@@ -0,0 +1,339 @@
+'''
+Run analytics store.
+
+Events of each run are appended to a binary file of fixed size records. When
+a run ends, a fixed size summary record is appended to an index file. The
+index is in run order, so a run is found by seeking to its record. A time
+range is found by a binary search over the start times in the index.
+
+The Pi has no real time clock, and before NTP has synced the clock may be
+behind the time of an earlier run. When the start times in the index are not
+in order, time range queries fall back to scanning the whole index.
+
+Files in the store directory:
+
+ * events.dat: run id, time, event type and value of each event.
+ * runs.idx: summary of each finished run, including where its events start.
+'''
+import os
+import struct
+import threading
+import time
+
+from log import logger
+
+
+RUNS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "runs")
+'''
+Directory where the runs are stored.
+'''
+
+START = 1
+STOP = 2
+LAP = 3
+COMMAND = 4
+LINE_LOST = 5
+
+EVENT_NAMES = {START: "start", STOP: "stop", LAP: "lap", COMMAND: "command", LINE_LOST: "line_lost"}
+'''
+Names of the event types, as used in the JSON output.
+'''
+
+EVENT = struct.Struct("<IdBf")
+'''
+Event record: run id, time, event type, value.
+'''
+
+SUMMARY = struct.Struct("<IddIfIIQI")
+'''
+Summary record: run id, start, stop, laps, best lap, commands, line losses,
+offset of the first event record, number of event records.
+'''
+
+SUMMARY_FIELDS = ("run", "start", "stop", "laps", "best_lap", "commands",
+                  "line_losses", "offset", "events")
+
+
+class RunStore(object):
+    '''
+    Append-only store of runs and their events.
+    '''
+    def __init__(self, directory=RUNS_DIR):
+        '''
+        Open the store in "directory", creating it if needed.
+
+        :param directory: Directory to store the runs in.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.events_path = os.path.join(directory, "events.dat")
+        self.index_path = os.path.join(directory, "runs.idx")
+        self.lock = threading.Lock()
+
+        self.events_file = open(self.events_path, "ab")
+        self.index_file = open(self.index_path, "ab")
+        # Cut off a partly written record at the end of the files, if the
+        # power went while writing.
+        for store_file, record in ((self.events_file, EVENT), (self.index_file, SUMMARY)):
+            size = os.fstat(store_file.fileno()).st_size
+            if size % record.size:
+                store_file.truncate(size - size % record.size)
+                store_file.seek(0, os.SEEK_END)
+
+        self.run_id = None
+        self.run_start = None
+        self.run_offset = None
+        self.last_lap = None
+
+        # Check if the start times can be searched.
+        self.ordered = True
+        self.last_start = None
+        with open(self.index_path, "rb") as index_file:
+            data = index_file.read()
+        for pos in range(0, len(data), SUMMARY.size):
+            self.check_order(SUMMARY.unpack_from(data, pos)[1])
+
+        self.recover()
+
+    def check_order(self, start):
+        '''
+        Keep track of whether the start times in the index are in order.
+
+        :param start: Start time of the run appended to the index.
+        '''
+        if self.last_start is not None and start < self.last_start:
+            if self.ordered:
+                logger.warning("Run start times are out of order, the clock went backwards. " +
+                               "Time range queries will scan all runs.")
+            self.ordered = False
+        self.last_start = start
+
+    def count(self):
+        '''
+        Return the number of finished runs.
+        '''
+        return os.path.getsize(self.index_path) // SUMMARY.size
+
+    def recover(self):
+        '''
+        Finish a run that was never stopped, because the program was killed.
+        '''
+        events = os.path.getsize(self.events_path) // EVENT.size
+        if self.count() > 0:
+            last = self.run(self.count())
+            indexed = last['offset'] // EVENT.size + last['events']
+        else:
+            indexed = 0
+        if events == indexed:
+            return
+
+        logger.warning("Recovering run " + str(self.count() + 1) + " that was not stopped")
+        with open(self.events_path, "rb") as events_file:
+            events_file.seek(indexed * EVENT.size)
+            data = events_file.read()
+        records = [EVENT.unpack_from(data, pos) for pos in range(0, len(data), EVENT.size)]
+        self.write_summary(self.count() + 1, indexed * EVENT.size, records)
+
+    def write_summary(self, run_id, offset, records):
+        '''
+        Summarise the events of a run, and append the summary to the index.
+
+        :param run_id: The id of the run.
+        :param offset: Position of the first event of the run in events.dat.
+        :param records: The event records of the run.
+        :return: The summary as a dictionary.
+        '''
+        start = records[0][1]
+        stop = records[-1][1]
+        laps = [value for rid, when, event, value in records if event == LAP]
+        commands = len([event for rid, when, event, value in records if event == COMMAND])
+        losses = len([event for rid, when, event, value in records if event == LINE_LOST])
+        best = 0.0
+        if len(laps) > 0:
+            best = min(laps)
+
+        record = SUMMARY.pack(run_id, start, stop, len(laps), best, commands, losses, offset,
+                              len(records))
+        self.check_order(start)
+        self.index_file.write(record)
+        self.index_file.flush()
+        # Return what was stored, the best lap is rounded to a float32.
+        return dict(zip(SUMMARY_FIELDS, SUMMARY.unpack(record)))
+
+    def record(self, event, value=0.0, when=None):
+        '''
+        Append an event to the current run. Does nothing when no run is going.
+
+        :param event: The event type.
+        :param value: Lap time, line loss duration or command number.
+        :param when: Time of the event, default is now.
+        '''
+        if when is None:
+            when = time.time()
+        with self.lock:
+            if self.run_id is None:
+                return
+            self.events_file.write(EVENT.pack(self.run_id, when, event, value))
+
+    def start(self):
+        '''
+        Start a new run.
+
+        :return: The id of the run.
+        '''
+        with self.lock:
+            if self.run_id is not None:
+                return self.run_id
+            self.run_id = self.count() + 1
+            self.run_start = time.time()
+            self.last_lap = self.run_start
+            self.run_offset = self.events_file.tell()
+            self.events_file.write(EVENT.pack(self.run_id, self.run_start, START, 0.0))
+            logger.info("Started run " + str(self.run_id))
+            return self.run_id
+
+    def lap(self):
+        '''
+        Mark the end of a lap in the current run.
+
+        :return: The lap time in seconds, or None when no run is going.
+        '''
+        now = time.time()
+        with self.lock:
+            if self.run_id is None:
+                return None
+            lap_time = now - self.last_lap
+            self.last_lap = now
+            self.events_file.write(EVENT.pack(self.run_id, now, LAP, lap_time))
+            self.events_file.flush()
+            return lap_time
+
+    def stop(self):
+        '''
+        Stop the current run, and add it to the index.
+
+        :return: The summary of the run, or None when no run was going.
+        '''
+        with self.lock:
+            if self.run_id is None:
+                return None
+            self.events_file.write(EVENT.pack(self.run_id, time.time(), STOP, 0.0))
+            self.events_file.flush()
+            with open(self.events_path, "rb") as events_file:
+                events_file.seek(self.run_offset)
+                data = events_file.read()
+            records = [EVENT.unpack_from(data, pos) for pos in range(0, len(data), EVENT.size)]
+            summary = self.write_summary(self.run_id, self.run_offset, records)
+            self.run_id = None
+            logger.info("Stopped run " + str(summary['run']))
+            return summary
+
+    def run(self, run_id):
+        '''
+        Get the summary of a finished run.
+
+        :param run_id: The id of the run, runs are numbered from 1.
+        :return: The summary as a dictionary, or None if there is no such run.
+        '''
+        if run_id < 1 or run_id > self.count():
+            return None
+        with open(self.index_path, "rb") as index_file:
+            index_file.seek((run_id - 1) * SUMMARY.size)
+            return dict(zip(SUMMARY_FIELDS, SUMMARY.unpack(index_file.read(SUMMARY.size))))
+
+    def runs(self, since=None, until=None, limit=None):
+        '''
+        Get the summaries of the runs started in a time range, newest first.
+
+        :param since: Only runs started at or after this time.
+        :param until: Only runs started before this time.
+        :param limit: Return at most this many runs, negative counts as 0.
+        :return: List of summaries.
+        '''
+        if not self.ordered:
+            return self.scan(since, until, limit)
+
+        with open(self.index_path, "rb") as index_file:
+            def start_of(number):
+                index_file.seek(number * SUMMARY.size)
+                return SUMMARY.unpack(index_file.read(SUMMARY.size))[1]
+
+            # Binary search for the first and last run in the range.
+            count = self.count()
+            first = 0
+            if since is not None:
+                first = bisect(start_of, since, 0, count)
+            last = count
+            if until is not None:
+                last = bisect(start_of, until, first, count)
+            if limit is not None:
+                first = max(first, last - max(limit, 0))
+
+            index_file.seek(first * SUMMARY.size)
+            data = index_file.read((last - first) * SUMMARY.size)
+        summaries = [dict(zip(SUMMARY_FIELDS, SUMMARY.unpack_from(data, pos)))
+                     for pos in range(0, len(data), SUMMARY.size)]
+        summaries.reverse()
+        return summaries
+
+    def scan(self, since=None, until=None, limit=None):
+        '''
+        Get the summaries of the runs started in a time range, by reading the
+        whole index. Used when the start times are out of order.
+
+        See runs() for the arguments.
+        '''
+        with open(self.index_path, "rb") as index_file:
+            data = index_file.read()
+        summaries = list()
+        for pos in range(0, len(data), SUMMARY.size):
+            summary = dict(zip(SUMMARY_FIELDS, SUMMARY.unpack_from(data, pos)))
+            if since is not None and summary['start'] < since:
+                continue
+            if until is not None and summary['start'] >= until:
+                continue
+            summaries.append(summary)
+        if limit is not None:
+            summaries = summaries[len(summaries) - min(max(limit, 0), len(summaries)):]
+        summaries.reverse()
+        return summaries
+
+    def events(self, run_id):
+        '''
+        Get the events of a finished run.
+
+        :param run_id: The id of the run.
+        :return: List of events as dictionaries, or None if there is no such run.
+        '''
+        summary = self.run(run_id)
+        if summary is None:
+            return None
+        with open(self.events_path, "rb") as events_file:
+            events_file.seek(summary['offset'])
+            data = events_file.read(summary['events'] * EVENT.size)
+        return [{'time': when, 'event': EVENT_NAMES.get(event, str(event)), 'value': value}
+                for rid, when, event, value in
+                [EVENT.unpack_from(data, pos) for pos in range(0, len(data), EVENT.size)]]
+
+    def close(self):
+        '''
+        Stop the current run, if any, and close the files.
+        '''
+        self.stop()
+        self.events_file.close()
+        self.index_file.close()
+
+
+def bisect(key, value, low, high):
+    '''
+    Find the first position in [low, high) where key(position) >= value.
+
+    :param key: Function returning the sort key at a position.
+    '''
+    while low < high:
+        mid = (low + high) // 2
+        if key(mid) < value:
+            low = mid + 1
+        else:
+            high = mid
+    return low
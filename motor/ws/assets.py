@@ -0,0 +1,91 @@
+'''
+Static assets of the web frontend.
+
+The assets are gzip compressed once, when the server starts, and served with
+the compressed copy to clients that accept it. URLs made with static_url()
+carry a fingerprint of the content, and are cached by the browser for a long
+time.
+'''
+import gzip
+import mimetypes
+import os
+import shutil
+
+import tornado.web
+
+from log import logger
+from staticfiles import STATIC_PATH, COMPRESSIBLE
+
+
+def precompress(path=STATIC_PATH, level=9):
+    '''
+    Write a gzip compressed copy next to each asset that does not have an up to date one.
+
+    :param path: Directory of the static assets.
+    :param level: gzip compression level, compression happens once so use the best.
+    :return: Number of files compressed.
+    '''
+    count = 0
+    for root, dirs, files in os.walk(path):
+        for name in files:
+            if not name.endswith(COMPRESSIBLE):
+                continue
+            source = os.path.join(root, name)
+            target = source + ".gz"
+            if os.path.isfile(target) and os.path.getmtime(target) >= os.path.getmtime(source):
+                continue
+            with open(source, "rb") as src, gzip.open(target, "wb", compresslevel=level) as dst:
+                shutil.copyfileobj(src, dst)
+            logger.debug("Compressed " + source + ": " + str(os.path.getsize(source)) +
+                         " -> " + str(os.path.getsize(target)) + " bytes")
+            count += 1
+    return count
+
+
+class StaticHandler(tornado.web.StaticFileHandler):
+    '''
+    Serve static files, using the pre-compressed copy when the client accepts gzip.
+    '''
+    def validate_absolute_path(self, root, absolute_path):
+        '''
+        Swap in the compressed copy of the file, if there is one and the client takes it.
+        '''
+        absolute_path = super(StaticHandler, self).validate_absolute_path(root, absolute_path)
+        self.compressed = False
+        if absolute_path is None:
+            return None
+        if "gzip" in self.request.headers.get("Accept-Encoding", ""):
+            if os.path.isfile(absolute_path + ".gz"):
+                self.compressed = True
+                return absolute_path + ".gz"
+        return absolute_path
+
+    def get_content_size(self):
+        '''
+        Get the size of the file that is sent, which may be the compressed copy.
+        '''
+        if self.compressed:
+            return os.path.getsize(self.absolute_path)
+        return super(StaticHandler, self).get_content_size()
+
+    def get_content_type(self):
+        '''
+        Get the content type from the uncompressed file name.
+        '''
+        path = self.absolute_path
+        if self.compressed:
+            path = path[:-len(".gz")]
+        mime_type, encoding = mimetypes.guess_type(path)
+        if mime_type is None:
+            return "application/octet-stream"
+        return mime_type
+
+    def set_extra_headers(self, path):
+        '''
+        Tell the client and any proxy how the content is encoded.
+        '''
+        # With compress_response, Tornado adds the Vary header itself.
+        if not self.settings.get("compress_response"):
+            self.set_header("Vary", "Accept-Encoding")
+        if self.compressed:
+            self.set_header("Content-Encoding", "gzip")
@@ -0,0 +1,102 @@
+#!/usr/bin/python3
+'''
+Benchmark the bytes sent on the wire to the web frontend.
+
+Compares the page, the static assets and a stream of telemetry messages,
+with and without compression. The WebSocket compression is done the same way
+as Tornado's permessage-deflate: a raw deflate stream kept between messages,
+flushed after each message, with the trailing empty block removed.
+
+Run it from this directory: ./bench_wire.py
+'''
+import gzip
+import os
+import random
+import zlib
+
+from tornado.options import define, options, parse_command_line
+import tornado.template
+
+from staticfiles import STATIC_PATH, COMPRESSIBLE
+
+
+define("messages", default=10000, help="Number of telemetry messages", type=int)
+
+
+def frame_size(payload):
+    '''
+    Size of a server to client WebSocket frame, which is not masked.
+
+    :param payload: Length of the payload in bytes.
+    '''
+    if payload < 126:
+        return 2 + payload
+    if payload < 65536:
+        return 4 + payload
+    return 10 + payload
+
+
+def telemetry(count):
+    '''
+    Make a stream of messages like the ones sent during a run.
+
+    :param count: Number of messages.
+    '''
+    rnd = random.Random(0)
+    messages = list()
+    val = 0
+    while len(messages) < count:
+        val = 1 - val
+        messages.append('Sensor event (pin 26): ' + str(val))
+        if val == 0:
+            messages.append('Forward: 25, 50')
+        else:
+            messages.append('Forward: 50, 25')
+        # Now and then a button or a command from the frontend.
+        if rnd.random() < 0.01:
+            messages.append('Button event (pin 23): ' + str(rnd.randint(0, 1)))
+    return messages[:count]
+
+
+def deflate_wire(messages, level, mem_level):
+    '''
+    Bytes on the wire for the messages sent with permessage-deflate.
+    '''
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS, mem_level)
+    total = 0
+    for message in messages:
+        data = compressor.compress(message.encode('utf-8'))
+        data += compressor.flush(zlib.Z_SYNC_FLUSH)
+        # The trailing 00 00 ff ff is not sent.
+        total += frame_size(len(data) - 4)
+    return total
+
+
+def main():
+    parse_command_line()
+
+    print("Page and assets (bytes):")
+    print("%-20s %10s %10s" % ("file", "plain", "gzip"))
+    loader = tornado.template.Loader(os.path.dirname(os.path.abspath(__file__)))
+    page = loader.load("index.html").generate(static_url=lambda path: "/static/" + path + "?v=0123456789abcdef0123456789abcdef")
+    print("%-20s %10d %10d" % ("index.html", len(page), len(gzip.compress(page, 6))))
+    for name in sorted(os.listdir(STATIC_PATH)):
+        if not name.endswith(COMPRESSIBLE):
+            continue
+        with open(os.path.join(STATIC_PATH, name), "rb") as asset:
+            data = asset.read()
+        print("%-20s %10d %10d" % (name, len(data), len(gzip.compress(data, 9))))
+
+    messages = telemetry(options.messages)
+    plain = sum([frame_size(len(message.encode('utf-8'))) for message in messages])
+    print("")
+    print("Telemetry, " + str(len(messages)) + " messages (bytes on the wire):")
+    print("%-20s %10d %9s" % ("uncompressed", plain, "100.0%"))
+    for level, mem_level in ((1, 8), (6, 8), (6, 4), (9, 9), (6, 1)):
+        size = deflate_wire(messages, level, mem_level)
+        print("%-20s %10d %8.1f%%" % ("level " + str(level) + ", mem " + str(mem_level),
+                                      size, 100.0 * size / plain))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,54 @@
+'''
+Send messages to the WebSocket clients from any thread.
+
+The sensor and button callbacks run in the RPi.GPIO thread, and the motor
+commands run in the GPIO executor, while the WebSocket connections belong to
+the event loop. Messages are therefore handed to the event loop, and written
+from there.
+'''
+import asyncio
+
+from log import logger
+
+
+loop = None
+'''
+The event loop of the WebSocket server.
+'''
+
+
+def init(io_loop):
+    '''
+    Set the event loop that the WebSocket connections run on.
+
+    :param io_loop: The Tornado IOLoop of the server.
+    '''
+    global loop
+    loop = io_loop
+
+
+async def send(connections, message):
+    '''
+    Write a message to all connections, and wait until it is sent.
+
+    :param connections: List of WebSocket connections.
+    :param message: The message to send.
+    '''
+    results = await asyncio.gather(*[connection.send(message) for connection in connections],
+                                   return_exceptions=True)
+    for result in results:
+        if isinstance(result, Exception):
+            logger.debug("Could not send message: " + str(result))
+
+
+def broadcast(connections, message):
+    '''
+    Send a message to all connections. Safe to call from any thread.
+
+    :param connections: List of WebSocket connections.
+    :param message: The message to send.
+    '''
+    if loop is None or len(connections) == 0:
+        return
+    # Copy the list, it may change before the event loop gets to it.
+    loop.add_callback(send, list(connections), message)
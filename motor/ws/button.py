@@ -1,6 +1,7 @@
 import RPi.GPIO as GPIO
 
 from log import logger
+from broadcast import broadcast
 
 
 class Button(object):
@@ -20,12 +21,12 @@ class Button(object):
         # Save the pin number
         self.pin = pin
         # Save the callback functions
-	if inv != True:
+        if inv != True:
             self.press_callback = press_callback
             self.release_callback = release_callback
         else:
             self.press_callback = release_callback
-            self.release_calback = press_callback
+            self.release_callback = press_callback
         # Set the pin as an input
         GPIO.setup(self.pin, GPIO.IN)
         #Setup event handling on the sensor
@@ -34,18 +35,24 @@ class Button(object):
 
     def addWebsocket(self, ws):
         '''
-        Add a WebSocket connection and return its index.
+        Add a WebSocket connection to the list of receivers.
+
+        :param ws: WebSocket connection.
+        :type ws: tornado.websocket.WebSocketHandler
         '''
         Button.websocket.append(ws)
         logger.debug("Added connection number " + str(len(Button.websocket)))
-        return(len(Button.websocket) - 1)
 
-    def removeWebsocket(self, index):
+    def removeWebsocket(self, ws):
         '''
-        Remove a WebSocket connection from the list of clients.
+        Remove a WebSocket connection from the list of receivers.
+
+        :param ws: WebSocket connection.
+        :type ws: tornado.websocket.WebSocketHandler
         '''
-        del Button.websocket[index]
-        logger.debug("Removed connection number " + str(index))
+        if ws in Button.websocket:
+            Button.websocket.remove(ws)
+            logger.debug("Removed connection, " + str(len(Button.websocket)) + " left")
 
     def read(self):
         '''
@@ -54,8 +61,7 @@ class Button(object):
         :return: 1 for pressed, 0 otherwise
         '''
         ret = GPIO.input(self.pin)
-        for connection in Button.websocket:
-            connection.write_message('Button (pin ' + str(self.pin) + '): ' + str(ret))
+        broadcast(Button.websocket, 'Button (pin ' + str(self.pin) + '): ' + str(ret))
 
         return ret
     
@@ -63,11 +69,10 @@ class Button(object):
         '''
         Called on both rising and falling edge. Dispatch to the right handler.
         '''
-	logger.debug('Input on button.')
+        logger.debug('Input on button.')
         val = GPIO.input(self.pin)
         
-        for connection in Button.websocket:
-            connection.write_message('Button event (pin ' + str(self.pin) + '): ' + str(val))
+        broadcast(Button.websocket, 'Button event (pin ' + str(self.pin) + '): ' + str(val))
         
         if val == 0:
             if self.press_callback is not None:
@@ -0,0 +1,314 @@
+'''
+Calibration of the analog light sensor.
+
+The comparator on the sensor board has its light/dark threshold fixed in
+hardware. When the sensor is read through an ADC instead, the threshold is
+found by sweeping the track at startup, and the result is saved as a profile
+on disk, so that a warm restart can skip the sweep.
+'''
+import json
+import math
+import os
+import random
+import time
+
+from log import logger
+
+
+PROFILE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "calibration")
+'''
+Directory where the calibration profiles are stored.
+'''
+
+MIN_CONTRAST = 0.1
+'''
+Smallest difference between the dark and light levels that makes a usable
+calibration, as a fraction of the full range of the sensor.
+'''
+
+
+class SimulatedSource(object):
+    '''
+    Simulated analog sensor, used when there is no ADC attached.
+
+    The value swings between a dark and a light level, as if the sensor was
+    moved back and forth across the edge of the line.
+    '''
+    name = "simulated"
+    '''
+    Type of the source, as stored in the calibration profile.
+    '''
+    channel = None
+    '''
+    The simulated sensor has no ADC channel.
+    '''
+
+    def __init__(self, dark=0.2, light=0.8, period=1.0, noise=0.02):
+        '''
+        Construct a simulated sensor source.
+
+        :param dark: The value returned when the sensor is over the line.
+        :param light: The value returned when the sensor is over the track.
+        :param period: Seconds for a full swing from dark to light and back.
+        :param noise: Amplitude of the random noise added to each reading.
+        '''
+        self.dark = dark
+        self.light = light
+        self.period = period
+        self.noise = noise
+        self.start = time.time()
+
+    def read(self):
+        '''
+        Read the simulated sensor.
+
+        :return: A value between 0.0 and 1.0.
+        '''
+        phase = (time.time() - self.start) / self.period
+        swing = (math.sin(2 * math.pi * phase) + 1) / 2
+        value = self.dark + (self.light - self.dark) * swing
+        value += random.uniform(-self.noise, self.noise)
+        return min(max(value, 0.0), 1.0)
+
+
+class MCP3008Source(object):
+    '''
+    Analog sensor read through a MCP3008 ADC on the SPI bus.
+    '''
+    name = "adc"
+    '''
+    Type of the source, as stored in the calibration profile.
+    '''
+
+    def __init__(self, channel=0, bus=0, device=0):
+        '''
+        Construct a source reading "channel" of the ADC.
+
+        :param channel: The ADC channel that the sensor is connected to.
+        :param bus: SPI bus number.
+        :param device: SPI chip select.
+        '''
+        # Only needed when an ADC is actually used.
+        import spidev
+
+        self.channel = channel
+        self.spi = spidev.SpiDev()
+        self.spi.open(bus, device)
+        self.spi.max_speed_hz = 1000000
+
+    def read(self):
+        '''
+        Read the sensor.
+
+        :return: A value between 0.0 and 1.0.
+        '''
+        # Start bit, single ended mode and channel, see the MCP3008 data sheet.
+        data = self.spi.xfer2([1, (8 + self.channel) << 4, 0])
+        return (((data[1] & 3) << 8) + data[2]) / 1023.0
+
+    def close(self):
+        '''
+        Release the SPI bus.
+        '''
+        self.spi.close()
+
+
+class Calibration(object):
+    '''
+    Light/dark thresholds of an analog sensor, with hysteresis.
+    '''
+    def __init__(self, dark=0.0, light=1.0, hysteresis=0.1, source=None, channel=None):
+        '''
+        Construct a calibration from the measured dark and light levels.
+
+        :param dark: The reading over the line.
+        :param light: The reading over the track.
+        :param hysteresis: Width of the dead band around the midpoint, as a
+                           fraction of the distance between dark and light.
+        :param source: Type of the source that was calibrated.
+        :param channel: ADC channel that was calibrated, if any.
+        '''
+        self.dark = dark
+        self.light = light
+        self.hysteresis = hysteresis
+        self.source = source
+        self.channel = channel
+
+        # Put the thresholds on either side of the midpoint.
+        mid = (dark + light) / 2.0
+        band = abs(light - dark) * hysteresis / 2.0
+        self.low = mid - band
+        self.high = mid + band
+
+    @property
+    def invert(self):
+        '''
+        True when the sensor reads higher over the line than over the track.
+        '''
+        return self.dark > self.light
+
+    def matches(self, source):
+        '''
+        Check if the calibration was made with the same kind of source and channel.
+
+        :param source: Analog sensor source with a read() method.
+        '''
+        return self.source == source.name and self.channel == source.channel
+
+    @classmethod
+    def sweep(cls, source, duration=3.0, interval=0.005, hysteresis=0.1, min_contrast=MIN_CONTRAST,
+              invert=False):
+        '''
+        Calibrate by reading the sensor while it is swept across the track.
+
+        :param source: Analog sensor source with a read() method.
+        :param duration: Seconds to sample the sensor.
+        :param interval: Seconds between samples.
+        :param hysteresis: Width of the dead band, see the constructor.
+        :param min_contrast: Smallest usable difference between dark and light.
+        :param invert: True if the sensor reads higher over the line, like a
+                       reflective IR sensor with a pull-up.
+        :return: The new calibration.
+        :raises ValueError: If the sensor did not see both the line and the track.
+        '''
+        logger.info("Calibrating sensor for " + str(duration) + " seconds")
+        samples = list()
+        end = time.time() + duration
+        while time.time() < end:
+            samples.append(source.read())
+            time.sleep(interval)
+
+        if len(samples) < 2:
+            raise ValueError("Not enough samples to calibrate the sensor")
+
+        # Use the 5th and 95th percentile, so that a few spikes do not move
+        # the thresholds.
+        samples.sort()
+        dark = samples[int(len(samples) * 0.05)]
+        light = samples[int(len(samples) * 0.95)]
+        if invert:
+            dark, light = light, dark
+        logger.debug("Calibration from " + str(len(samples)) + " samples, dark: " +
+                     str(dark) + ", light: " + str(light))
+        # If the sensor was not moved across the line, the thresholds end up
+        # in the noise.
+        if abs(light - dark) < min_contrast:
+            logger.warning("Calibration failed, the difference between dark and light is only " +
+                           str(abs(light - dark)) + ". Move the sensor across the line while calibrating.")
+            raise ValueError("Too little contrast to calibrate the sensor")
+        return cls(dark, light, hysteresis, source.name, source.channel)
+
+    def classify(self, value, previous):
+        '''
+        Turn a reading into a sensor state, using the hysteresis band.
+
+        :param value: The reading from the sensor.
+        :param previous: The previous state of the sensor.
+        :return: 0 for light, 1 for dark, like the comparator output.
+        '''
+        # The dark level may be above or below the light level, depending on
+        # the sensor.
+        if self.dark < self.light:
+            if value <= self.low:
+                return 1
+            if value >= self.high:
+                return 0
+        else:
+            if value >= self.high:
+                return 1
+            if value <= self.low:
+                return 0
+        # Inside the dead band, keep the state.
+        return previous
+
+    def to_dict(self):
+        '''
+        Return the calibration as a dictionary.
+        '''
+        return {'dark': self.dark,
+                'light': self.light,
+                'hysteresis': self.hysteresis,
+                'invert': self.invert,
+                'source': self.source,
+                'channel': self.channel,
+                'low': self.low,
+                'high': self.high,
+                'time': time.time()}
+
+    def save(self, name="default", directory=PROFILE_DIR):
+        '''
+        Save the calibration as a profile.
+
+        :param name: The name of the profile.
+        :param directory: Directory to store the profile in.
+        '''
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        path = os.path.join(directory, name + ".json")
+        # Write to a temporary file first, so that a power cut does not leave
+        # a broken profile behind.
+        with open(path + ".tmp", "w") as profile:
+            json.dump(self.to_dict(), profile, indent=4)
+        os.rename(path + ".tmp", path)
+        logger.info("Saved calibration profile " + path)
+
+    @classmethod
+    def load(cls, name="default", directory=PROFILE_DIR):
+        '''
+        Load a calibration profile.
+
+        :param name: The name of the profile.
+        :param directory: Directory where the profile is stored.
+        :return: The calibration, or None if there is no usable profile.
+        '''
+        path = os.path.join(directory, name + ".json")
+        try:
+            with open(path, "r") as profile:
+                data = json.load(profile)
+            calibration = cls(data['dark'], data['light'], data['hysteresis'],
+                              data.get('source'), data.get('channel'))
+        except (IOError, OSError, ValueError, KeyError) as exception:
+            logger.debug("No calibration profile " + path + ": " + str(exception))
+            return None
+
+        if abs(calibration.light - calibration.dark) < MIN_CONTRAST:
+            logger.warning("Ignoring calibration profile " + path + " with too little contrast")
+            return None
+
+        logger.info("Loaded calibration profile " + path)
+        return calibration
+
+
+def calibrate(source, name="default", force=False, invert=False, **kwargs):
+    '''
+    Load the calibration profile, or sweep the sensor if there is none.
+
+    :param source: Analog sensor source with a read() method.
+    :param name: The name of the profile.
+    :param force: Sweep the sensor even if a profile exists.
+    :param invert: True if the sensor reads higher over the line.
+    :return: The calibration.
+    :raises ValueError: If the sweep failed and there is no usable profile.
+    '''
+    calibration = Calibration.load(name)
+    if calibration is not None and calibration.invert != invert:
+        logger.warning("Calibration profile " + name + " has the other polarity, calibrating again")
+        calibration = None
+    # A profile from another sensor or ADC channel has the wrong levels.
+    if calibration is not None and not calibration.matches(source):
+        logger.warning("Calibration profile " + name + " is for " + str(calibration.source) +
+                       " channel " + str(calibration.channel) + ", calibrating again")
+        calibration = None
+    if calibration is not None and not force:
+        return calibration
+
+    try:
+        swept = Calibration.sweep(source, invert=invert, **kwargs)
+    except ValueError:
+        # Keep running on the stored profile, rather than not starting at all.
+        if calibration is None:
+            raise
+        logger.warning("Calibration rejected, using the stored profile " + name)
+        return calibration
+    swept.save(name)
+    return swept
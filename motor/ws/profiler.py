@@ -0,0 +1,153 @@
+'''
+Sampling profiler for the running server.
+
+A background thread takes the Python stack of every other thread at a fixed
+interval, and counts how often each stack is seen. The result is written in
+the folded stack format, one stack per line with the frames separated by
+";" followed by the count, which is what flamegraph.pl and speedscope read.
+'''
+import collections
+import os
+import sys
+import threading
+import time
+
+from log import logger
+
+
+class Profiler(object):
+    '''
+    Sample the stacks of the running threads.
+    '''
+    def __init__(self, interval=0.01, names=None):
+        '''
+        Construct a profiler.
+
+        :param interval: Seconds between samples.
+        :param names: Dictionary of thread ids to names, for threads that the
+                      threading module does not know the name of.
+        '''
+        self.interval = interval
+        self.names = dict()
+        if names is not None:
+            self.names.update(names)
+        self.lock = threading.Lock()
+        self.stacks = collections.Counter()
+        self.samples = 0
+        self.started = None
+        self.stopped = None
+        self.thread = None
+        self.stop_event = threading.Event()
+        # Counts the runs, so that a caller only stops the run it started.
+        self.generation = 0
+
+    @property
+    def running(self):
+        '''
+        True while sampling.
+        '''
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, duration=None):
+        '''
+        Clear the previous samples and start sampling.
+
+        :param duration: Stop after this many seconds, or sample until stop() is called.
+        :return: Number of the run, to pass to stop(), or None if already running.
+        '''
+        if self.running:
+            return None
+        self.generation += 1
+        with self.lock:
+            self.stacks.clear()
+            self.samples = 0
+        self.started = time.time()
+        self.stopped = None
+        self.stop_event.clear()
+        self.thread = threading.Thread(target=self.run, args=(duration,), name="Profiler")
+        self.thread.daemon = True
+        self.thread.start()
+        logger.info("Profiler started, sampling every " + str(self.interval) + " seconds")
+        return self.generation
+
+    def stop(self, generation=None):
+        '''
+        Stop sampling.
+
+        :param generation: Only stop if this run, as returned by start(), is
+                           still going. Stop any run if None.
+        '''
+        if not self.running:
+            return
+        if generation is not None and generation != self.generation:
+            return
+        self.stop_event.set()
+        self.thread.join()
+
+    def run(self, duration):
+        '''
+        Take samples until stopped.
+        '''
+        own = threading.current_thread().ident
+        end = None
+        if duration is not None:
+            end = time.time() + duration
+        while not self.stop_event.wait(self.interval):
+            if end is not None and time.time() >= end:
+                break
+            self.sample(own)
+        self.stopped = time.time()
+        logger.info("Profiler stopped after " + str(self.samples) + " samples")
+
+    def sample(self, own):
+        '''
+        Take one sample of the stacks of all threads but the profiler.
+
+        :param own: Thread id of the profiler.
+        '''
+        # Look up the thread names once for each sample.
+        names = dict([(thread.ident, thread.name) for thread in threading.enumerate()])
+        names.update(self.names)
+
+        stacks = list()
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            stack = list()
+            while frame is not None:
+                code = frame.f_code
+                stack.append(code.co_name + " (" + os.path.basename(code.co_filename) + ")")
+                frame = frame.f_back
+            # The RPi.GPIO callbacks run in a thread started from C, which
+            # threading does not know the name of.
+            stack.append(names.get(ident, "gpio-" + str(ident)))
+            stack.reverse()
+            stacks.append(";".join(stack))
+
+        with self.lock:
+            self.samples += 1
+            self.stacks.update(stacks)
+
+    def folded(self):
+        '''
+        Return the samples as folded stacks, most common first.
+        '''
+        with self.lock:
+            stacks = self.stacks.most_common()
+        return "".join([stack + " " + str(count) + "\n" for stack, count in stacks])
+
+    def summary(self):
+        '''
+        Return a short description of the current profile.
+        '''
+        if self.started is None:
+            return "Profiler: no profile"
+        end = self.stopped
+        if end is None:
+            end = time.time()
+        state = "stopped"
+        if self.running:
+            state = "running"
+        return ("Profiler: " + state + ", " + str(self.samples) + " samples in " +
+                "%.1f" % (end - self.started) + " seconds, " +
+                str(len(self.stacks)) + " stacks")
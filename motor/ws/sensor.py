@@ -1,6 +1,31 @@
+import collections
+import threading
+import time
+
 import RPi.GPIO as GPIO
 
 from log import logger
+from broadcast import broadcast
+
+
+INTERRUPT = "interrupt"
+'''
+Read the sensor on edge interrupts from RPi.GPIO.
+'''
+POLLING = "polling"
+'''
+Read the sensor in a tight timed loop.
+'''
+ADAPTIVE = "adaptive"
+'''
+Switch between interrupts and polling, depending on the edge rate.
+'''
+
+PAIR_WINDOW = 0.05
+'''
+Seconds within which an interrupt and a reference reading are taken to be
+the same edge. Less than the bounce time, so edges are not mixed up.
+'''
 
 
 class Sensor(object):
@@ -11,36 +36,92 @@ class Sensor(object):
     '''
     Keep a list of WebSocket connections, to send the current status to.
     '''
-    def __init__(self, pin=26, light_callback=None, dark_callback=None):
+    def __init__(self, pin=26, light_callback=None, dark_callback=None, mode=INTERRUPT,
+                 interval=0.0005, high_rate=8.0, low_rate=2.0, window=1.0, bouncetime=0.1):
         '''
         Construct an object for a sensor connected to "pin"
         
+        Interrupts cost no CPU while the sensor is quiet, but each edge is
+        handed from the RPi.GPIO thread to Python. Polling sees an edge
+        within "interval", at the cost of a busy thread. Both modes ignore
+        edges closer than "bouncetime" to the previous one. In adaptive mode the sensor
+        polls while the edge rate is above "high_rate", and goes back to
+        interrupts when it falls below "low_rate".
+
         :param pin: The pin that the sensor board is connected to, using Broadcomm numbering.
+        :param mode: INTERRUPT, POLLING or ADAPTIVE.
+        :param interval: Seconds between readings when polling.
+        :param high_rate: Edges per second above which to start polling.
+        :param low_rate: Edges per second below which to go back to interrupts.
+        :param window: Seconds over which the edge rate is measured.
+        :param bouncetime: Seconds after an edge during which changes are ignored.
         '''
         # Save the pin number
         self.pin = pin
         # Save the callback functions
         self.light_callback = light_callback
         self.dark_callback = dark_callback
+        # Save the acquisition settings
+        self.adaptive = mode == ADAPTIVE
+        self.interval = interval
+        self.high_rate = high_rate
+        self.low_rate = low_rate
+        self.window = window
+        self.bouncetime = bouncetime
+        self.init_stats()
         # Set the pin as an input
         GPIO.setup(self.pin, GPIO.IN)
-        #Setup event handling on the sensor
-        GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self.event_dispatch, bouncetime=100)
+        self.state = GPIO.input(self.pin)
+        if mode == POLLING:
+            self.mode = POLLING
+            self.polling_since = time.perf_counter()
+        else:
+            self.mode = INTERRUPT
+            #Setup event handling on the sensor
+            GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self.event_dispatch,
+                                  bouncetime=int(self.bouncetime * 1000))
+        # Polling, and switching between the modes, happens in a thread of its own.
+        if mode != INTERRUPT:
+            self.wake = threading.Event()
+            self.thread = threading.Thread(target=self.acquire, name="Sensor")
+            self.thread.daemon = True
+            self.thread.start()
+
+    def init_stats(self):
+        '''
+        Set up the edge rate and latency measurements.
+        '''
+        self.lock = threading.Lock()
+        self.edges = collections.deque()
+        self.stats = {INTERRUPT: [0, 0.0, None], POLLING: [0, 0.0, None]}
+        self.last_poll = time.perf_counter()
+        self.polling_since = None
+        self.last_change = float('-inf')
+        # Reference readings for measuring the interrupt latency.
+        self.probe_until = 0.0
+        self.probe_thread = None
+        self.pending = None
 
     def addWebsocket(self, ws):
         '''
-        Add a WebSocket connection and return its index.
+        Add a WebSocket connection to the list of receivers.
+
+        :param ws: WebSocket connection.
+        :type ws: tornado.websocket.WebSocketHandler
         '''
         Sensor.websocket.append(ws)
         logger.debug("Added connection number " + str(len(Sensor.websocket)))
-        return(len(Sensor.websocket) - 1)
 
-    def removeWebsocket(self, index):
+    def removeWebsocket(self, ws):
         '''
-        Remove a WebSocket connection from the list of clients.
+        Remove a WebSocket connection from the list of receivers.
+
+        :param ws: WebSocket connection.
+        :type ws: tornado.websocket.WebSocketHandler
         '''
-        del Sensor.websocket[index]
-        logger.debug("Removed connection number " + str(index))
+        if ws in Sensor.websocket:
+            Sensor.websocket.remove(ws)
+            logger.debug("Removed connection, " + str(len(Sensor.websocket)) + " left")
 
     def read(self):
         '''
@@ -49,8 +130,7 @@ class Sensor(object):
         :return: 0 for low, 1 for high
         '''
         ret = GPIO.input(self.pin)
-        for connection in Sensor.websocket:
-            connection.write_message('Sensor (pin ' + str(self.pin) + '): ' + str(ret))
+        broadcast(Sensor.websocket, 'Sensor (pin ' + str(self.pin) + '): ' + str(ret))
 
         return ret
     
@@ -58,14 +138,249 @@ class Sensor(object):
         '''
         Called on both rising and falling edge. Dispatch to the right handler.
         '''
+        self.state = GPIO.input(self.pin)
+        self.last_change = time.perf_counter()
+        self.dispatch(self.state, INTERRUPT)
+        # Let the acquisition thread switch to polling, it is not safe to
+        # remove the event detection from inside the callback.
+        if self.adaptive and self.rate(time.perf_counter()) > self.high_rate:
+            self.wake.set()
+
+    def acquire(self):
+        '''
+        Poll the sensor, and switch between polling and interrupts in adaptive mode.
+        '''
+        while True:
+            if self.mode == INTERRUPT:
+                # Sleep until the edge rate gets high.
+                self.wake.wait()
+                self.wake.clear()
+                GPIO.remove_event_detect(self.pin)
+                self.polling_since = self.last_poll = time.perf_counter()
+                self.mode = POLLING
+                logger.debug("Sensor switched to polling at " + str(self.rate(self.last_poll)) + " edges/s")
+                self.poll_once()
+                continue
+
+            now = self.poll_once()
+            if (self.adaptive and now - self.polling_since > self.window and
+                    self.rate(now) < self.low_rate):
+                GPIO.add_event_detect(self.pin, GPIO.BOTH, callback=self.event_dispatch,
+                                      bouncetime=int(self.bouncetime * 1000))
+                self.mode = INTERRUPT
+                logger.debug("Sensor switched to interrupts at " + str(self.rate(now)) + " edges/s")
+                # Catch an edge between the last reading and enabling the interrupt.
+                self.poll_once()
+                continue
+            time.sleep(self.interval)
+
+    def poll_once(self):
+        '''
+        Read the sensor once, and dispatch if it changed.
+
+        :return: The time of the reading.
+        '''
         val = GPIO.input(self.pin)
-        
-        for connection in Sensor.websocket:
-            connection.write_message('Sensor event (pin ' + str(self.pin) + '): ' + str(val))
-            
+        now = time.perf_counter()
+        # Like the interrupts, ignore chatter right after an edge. A change
+        # that is still there after the bounce time is dispatched then.
+        if val != self.state and now - self.last_change >= self.bouncetime:
+            self.state = val
+            self.last_change = now
+            self.dispatch(val, POLLING, now)
+        self.last_poll = now
+        return now
+
+    def measure(self, duration=5.0):
+        '''
+        Measure the interrupt latency for "duration" seconds.
+
+        Python cannot see when the kernel saw an edge, so a probe thread
+        reads the pin every "interval" seconds meanwhile, as a reference for
+        when the edge could be seen. The probe costs the same CPU as polling.
+
+        :param duration: Seconds to measure.
+        '''
+        with self.lock:
+            self.probe_until = time.perf_counter() + duration
+            if self.probe_thread is not None and self.probe_thread.is_alive():
+                return
+            self.probe_thread = threading.Thread(target=self.probe, name="SensorProbe")
+            self.probe_thread.daemon = True
+            self.probe_thread.start()
+
+    def probe(self):
+        '''
+        Read the pin, as a reference for the interrupts, until the measurement ends.
+        '''
+        state = GPIO.input(self.pin)
+        while time.perf_counter() < self.probe_until:
+            val = GPIO.input(self.pin)
+            now = time.perf_counter()
+            if val != state:
+                state = val
+                if self.mode == INTERRUPT:
+                    with self.lock:
+                        self.pair(val, now, False)
+            time.sleep(self.interval)
+
+    def pair(self, val, when, handled):
+        '''
+        Match an interrupt with the reference reading of the same edge, and
+        record the latency. Call with the lock held.
+
+        :param val: The new value of the pin.
+        :param when: Time of the handler call or of the reference reading.
+        :param handled: True for the handler call, False for the reading.
+        '''
+        pending = self.pending
+        if (pending is not None and pending[0] == val and pending[2] != handled and
+                abs(when - pending[1]) < PAIR_WINDOW):
+            self.pending = None
+            if handled:
+                self.record(INTERRUPT, when - pending[1])
+            else:
+                self.record(INTERRUPT, pending[1] - when)
+        else:
+            self.pending = (val, when, handled)
+
+    def record(self, mode, latency):
+        '''
+        Add a latency measurement. Call with the lock held.
+        '''
+        stats = self.stats[mode]
+        stats[0] += 1
+        stats[1] += latency
+        if stats[2] is None or latency > stats[2]:
+            stats[2] = latency
+
+    def rate(self, now):
+        '''
+        Return the number of edges per second over the last window.
+
+        :param now: The current time.perf_counter().
+        '''
+        with self.lock:
+            while len(self.edges) > 0 and self.edges[0] < now - self.window:
+                self.edges.popleft()
+            return len(self.edges) / self.window
+
+    def latency(self):
+        '''
+        Return the measured acquisition latency of each mode.
+
+        Both modes are measured from the same point: the first reading, at
+        "interval" seconds, that saw the new value, to the call of the
+        handler. When polling, that reading is the poll itself. For
+        interrupts it is the probe started by measure(), and only edges seen
+        during a measurement count. The interrupt latency can be negative,
+        when the interrupt beats the next reading.
+
+        :return: Dictionary of mode to the number of edges, and the mean
+                 and max latency in seconds.
+        '''
+        with self.lock:
+            ret = dict()
+            for mode, (count, total, worst) in self.stats.items():
+                mean = None
+                if count > 0:
+                    mean = total / count
+                ret[mode] = {'edges': count, 'mean': mean, 'max': worst}
+            return ret
+
+    def dispatch(self, val, mode, detected=None):
+        '''
+        Tell the connected clients about a new sensor value, and call the handler.
+
+        :param val: 0 for light, 1 for dark.
+        :param mode: The mode that the value was read in.
+        :param detected: time.perf_counter() of the reading that saw the
+                         edge, None for interrupts.
+        '''
+        broadcast(Sensor.websocket, 'Sensor event (pin ' + str(self.pin) + '): ' + str(val))
+
+        # Measure the latency up to the handler.
+        now = time.perf_counter()
+        with self.lock:
+            # The edge times are only needed to switch modes, keep the last
+            # window of them.
+            if self.adaptive:
+                self.edges.append(now)
+                while self.edges[0] < now - self.window:
+                    self.edges.popleft()
+            if detected is not None:
+                self.record(mode, now - detected)
+            elif now < self.probe_until:
+                self.pair(val, now, True)
+
         if val == 0:
             if self.light_callback is not None:
                 self.light_callback()
         else:
             if self.dark_callback is not None:
-                self.dark_callback()
\ No newline at end of file
+                self.dark_callback()
+
+
+class AnalogSensor(Sensor):
+    '''
+    This class is the interface to an IR sensor read through an ADC.
+
+    The light/dark decision is made in software using a calibration, instead
+    of by the comparator on the sensor board.
+    '''
+    def __init__(self, source, calibration, light_callback=None, dark_callback=None, interval=0.002):
+        '''
+        Construct an object for a sensor read from "source"
+
+        :param source: Analog sensor source with a read() method.
+        :param calibration: The calibration.Calibration to use.
+        :param interval: Seconds between readings of the sensor.
+        '''
+        # There is no pin, but keep the attribute for the messages.
+        self.pin = 'adc'
+        self.source = source
+        self.calibration = calibration
+        self.interval = interval
+        # Save the callback functions
+        self.light_callback = light_callback
+        self.dark_callback = dark_callback
+        # The ADC can only be polled.
+        self.adaptive = False
+        self.mode = POLLING
+        self.init_stats()
+        # Start out in the state of the first reading.
+        self.state = calibration.classify(source.read(), 0)
+        # Read the sensor in the background, and dispatch on changes.
+        self.thread = threading.Thread(target=self.poll, name="AnalogSensor")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self):
+        '''
+        Read the state of the sensor.
+
+        :return: 0 for light, 1 for dark
+        '''
+        ret = self.calibration.classify(self.source.read(), self.state)
+        broadcast(Sensor.websocket, 'Sensor (pin ' + str(self.pin) + '): ' + str(ret))
+
+        return ret
+
+    def measure(self, duration=5.0):
+        '''
+        The ADC is always polled, so there is no interrupt latency to measure.
+        '''
+        pass
+
+    def poll(self):
+        '''
+        Read the sensor until the program exits, and dispatch when the state changes.
+        '''
+        while True:
+            val = self.calibration.classify(self.source.read(), self.state)
+            now = time.perf_counter()
+            if val != self.state:
+                self.state = val
+                self.dispatch(val, POLLING, now)
+            self.last_poll = now
+            time.sleep(self.interval)
@@ -1,19 +1,30 @@
-#!/usr/bin/python
+#!/usr/bin/python3
 
-import sys
+import asyncio
+import json
 import logging
+import math
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 
 import tornado.httpserver
 import tornado.websocket
 import tornado.ioloop
+import tornado.log
 import tornado.web
 from tornado.options import define, options, parse_command_line
 
 import RPi.GPIO as GPIO
 
 from t9 import T9
-from sensor import Sensor
+from sensor import Sensor, AnalogSensor, INTERRUPT, POLLING, ADAPTIVE
+from calibration import SimulatedSource, MCP3008Source, calibrate
 from button import Button
+from assets import STATIC_PATH, StaticHandler, precompress
+from profiler import Profiler
+from analytics import RunStore, COMMAND, LINE_LOST
+import broadcast
 
 from log import logger, init_file_log, init_console_log, close_log
 
@@ -21,6 +32,12 @@ from log import logger, init_file_log, init_console_log, close_log
 # Setup "debug" and "port" as extra command line options.
 define("debug", default=False, help="Output debug messages on console", type=bool)
 define("port", default=8080, help="Listen on the given port", type=int)
+define("sensor", default="comparator", help="Light sensor input: comparator, adc or simulated", type=str)
+define("sensor_mode", default="adaptive", help="Comparator input: interrupt, polling or adaptive", type=str)
+define("adc_channel", default=0, help="ADC channel of the light sensor", type=int)
+define("sensor_invert", default=False, help="The analog light sensor reads higher over the line", type=bool)
+define("calibrate", default=False, help="Calibrate the light sensor, even if a profile exists", type=bool)
+define("profile", default="default", help="Name of the light sensor calibration profile", type=str)
 
 
 LEFT_MOTOR = (17, 22, 17)
@@ -29,15 +46,170 @@ LIGHT_SENSOR = 26
 START_BUTTON = 23
 STOP_BUTTON =24
 
+MAX_PENDING = 16
+'''
+Messages that may be waiting to be sent to a client, before new ones are dropped.
+'''
+
+GPIO_EXECUTOR = ThreadPoolExecutor(max_workers=1)
+'''
+Executor for blocking GPIO calls. A single worker keeps the commands in order.
+'''
+
+COMMANDS = ("forward", "left", "right", "reverse", "stop")
+'''
+Commands from the frontend, the position is the number stored in the run analytics.
+'''
+
+LINE_LOSS_TIME = 1.0
+'''
+Seconds without a sensor edge, before the line counts as lost.
+'''
+
+RUN_STORE = None
+'''
+Run analytics store, opened by main().
+'''
+
+PROFILER = Profiler()
+'''
+Sampling profiler, started and stopped from the frontend or /profile.
+'''
+
+PROFILE_MAX_SECONDS = 300
+'''
+Longest profile that can be asked for through /profile, and longest a
+profile started over the WebSocket runs when it is not stopped.
+'''
+
+WS_COMPRESSION = {'compression_level': 6, 'mem_level': 4}
+'''
+Options for WebSocket permessage-deflate. The messages are short and alike, so
+most of the gain comes from keeping the context between messages, and a
+smaller memory level saves RAM on the Pi for each client.
+'''
+
+
+SENSOR_SOURCE = None
+'''
+Analog source of the light sensor, None when using the comparator.
+'''
+SENSOR_CALIBRATION = None
+'''
+Calibration of the analog light sensor.
+'''
+
+
+def init_sensor():
+    '''
+    Set up the light sensor selected on the command line, and calibrate it if needed.
+    '''
+    global SENSOR_SOURCE, SENSOR_CALIBRATION
+
+    if options.sensor_mode not in (INTERRUPT, POLLING, ADAPTIVE):
+        raise ValueError("Unknown sensor mode " + options.sensor_mode)
+
+    if options.sensor == "comparator":
+        return
+
+    if options.sensor == "adc":
+        SENSOR_SOURCE = MCP3008Source(channel=options.adc_channel)
+    elif options.sensor == "simulated":
+        SENSOR_SOURCE = SimulatedSource()
+    else:
+        raise ValueError("Unknown sensor type " + options.sensor)
+    # Use the stored profile, unless asked to calibrate.
+    SENSOR_CALIBRATION = calibrate(SENSOR_SOURCE, name=options.profile, force=options.calibrate,
+                                   invert=options.sensor_invert)
+    logger.info("Sensor thresholds, low: " + str(SENSOR_CALIBRATION.low) +
+                ", high: " + str(SENSOR_CALIBRATION.high))
+
+
+def create_sensor(light_callback=None, dark_callback=None):
+    '''
+    Create the light sensor set up by init_sensor().
+    '''
+    if SENSOR_SOURCE is None:
+        return Sensor(pin=LIGHT_SENSOR, light_callback=light_callback, dark_callback=dark_callback,
+                      mode=options.sensor_mode)
+    return AnalogSensor(SENSOR_SOURCE, SENSOR_CALIBRATION, light_callback=light_callback, dark_callback=dark_callback)
+
 
 class IndexHandler(tornado.web.RequestHandler):
     def get(self):
         '''
         Show the index.html page
         '''
+        # The page is small, but the assets it links to are cached for long.
+        # Have the browser check the ETag of the page on each load, so that it
+        # picks up new asset fingerprints.
+        self.set_header("Cache-Control", "no-cache")
         self.render("index.html")
 
 
+class ProfileHandler(tornado.web.RequestHandler):
+    async def get(self):
+        '''
+        Return the profile as folded stacks.
+
+        With the "seconds" argument, run the profiler for that long first.
+        '''
+        seconds = self.get_argument("seconds", None)
+        if seconds is not None:
+            try:
+                seconds = float(seconds)
+            except ValueError:
+                raise tornado.web.HTTPError(400, "seconds must be a number")
+            # nan and inf would never end the profile or the request.
+            if not math.isfinite(seconds) or seconds <= 0 or seconds > PROFILE_MAX_SECONDS:
+                raise tornado.web.HTTPError(400, "seconds must be more than 0 and at most " +
+                                            str(PROFILE_MAX_SECONDS))
+            if PROFILER.running:
+                raise tornado.web.HTTPError(409, "The profiler is already running")
+            generation = PROFILER.start(duration=seconds)
+            await asyncio.sleep(seconds)
+            # Only stop our own run, not one started from the frontend since.
+            await tornado.ioloop.IOLoop.current().run_in_executor(None, PROFILER.stop, generation)
+            if PROFILER.generation != generation:
+                raise tornado.web.HTTPError(409, "The profile was restarted while sampling")
+
+        self.set_header("Content-Type", "text/plain; charset=UTF-8")
+        self.set_header("Cache-Control", "no-store")
+        self.write(PROFILER.folded())
+
+
+class RunsHandler(tornado.web.RequestHandler):
+    def get(self, run_id=None):
+        '''
+        Return run summaries as JSON.
+
+        Without a run id, return the runs started between the "since" and
+        "until" arguments, newest first and at most "limit" of them. With a
+        run id, return the summary and the events of that run.
+        '''
+        self.set_header("Cache-Control", "no-cache")
+        if run_id is not None:
+            summary = RUN_STORE.run(int(run_id))
+            if summary is None:
+                raise tornado.web.HTTPError(404, "No run " + run_id)
+            self.write({'summary': summary, 'events': RUN_STORE.events(int(run_id))})
+            return
+
+        try:
+            since = self.get_argument("since", None)
+            if since is not None:
+                since = float(since)
+            until = self.get_argument("until", None)
+            if until is not None:
+                until = float(until)
+            limit = int(self.get_argument("limit", "100"))
+        except ValueError:
+            raise tornado.web.HTTPError(400, "since, until and limit must be numbers")
+        if limit < 0:
+            raise tornado.web.HTTPError(400, "limit must not be negative")
+        self.write({'runs': RUN_STORE.runs(since=since, until=until, limit=limit)})
+
+
 class WebSocketHandler(tornado.websocket.WebSocketHandler):
     '''
     Handle the WebSocket connections from the web frontend.
@@ -62,6 +234,14 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
     '''
     True when the line follower program is running
     '''
+    last_edge = None
+    '''
+    Time of the last sensor edge while running.
+    '''
+    pending = 0
+    '''
+    Number of messages waiting to be sent to this client.
+    '''
     def __init__(self, application, request, **kwargs):
         '''
         Constructor for the WebSocket handler.
@@ -69,22 +249,28 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         # If there is no robot instance create both that and the sensor instance.
         if WebSocketHandler.robot is None:
             WebSocketHandler.robot = T9(lpins=LEFT_MOTOR, rpins=RIGHT_MOTOR)
-            WebSocketHandler.sensor = Sensor(pin=LIGHT_SENSOR, light_callback=self.event_light, dark_callback=self.event_dark)
+            WebSocketHandler.sensor = create_sensor(light_callback=self.event_light, dark_callback=self.event_dark)
             WebSocketHandler.start_btn = Button(pin=START_BUTTON, press_callback=self.event_run)
             WebSocketHandler.stop_btn = Button(pin=STOP_BUTTON, press_callback=self.event_stop)
         # Call the parent constructor.
         super(WebSocketHandler, self).__init__(application, request, **kwargs)
 
+    def get_compression_options(self):
+        '''
+        Enable permessage-deflate compression of the WebSocket messages.
+        '''
+        return WS_COMPRESSION
+
     def open(self):
         '''
         This is called when someone opens a connection.
         '''
         logger.info("New connection was opened")
         # Add the connection to the robot and sensor, so that the may cry out.
-        self.rid = WebSocketHandler.robot.addWebsocket(self)
-        self.sid = WebSocketHandler.sensor.addWebsocket(self)
+        WebSocketHandler.robot.addWebsocket(self)
+        WebSocketHandler.sensor.addWebsocket(self)
 
-    def on_message(self, message):
+    async def on_message(self, message):
         '''
         This is called whenever a Websocket messages arrives.
         '''
@@ -93,29 +279,82 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         for command in message.split('\n'):
             command = command.lower().strip()
             logger.debug("Command " + command)
+            if command in COMMANDS:
+                RUN_STORE.record(COMMAND, COMMANDS.index(command))
+
             if (command == "forward"):
-                WebSocketHandler.robot.forward(100, 90)
+                await self.gpio(WebSocketHandler.robot.forward, 100, 90)
 
             if (command == "left"):
-                WebSocketHandler.robot.forward(100, 50)
+                await self.gpio(WebSocketHandler.robot.forward, 100, 50)
 
             if (command == "right"):
-                WebSocketHandler.robot.forward(50, 100)
+                await self.gpio(WebSocketHandler.robot.forward, 50, 100)
 
             if (command == "reverse"):
-                WebSocketHandler.robot.reverse(100, 80)
+                await self.gpio(WebSocketHandler.robot.reverse, 100, 80)
 
             if (command == "stop"):
-                WebSocketHandler.robot.stop()
+                await self.gpio(WebSocketHandler.robot.stop)
+
+            if (command == "lap"):
+                lap_time = RUN_STORE.lap()
+                if lap_time is not None:
+                    await self.send('Lap: ' + "%.3f" % lap_time)
+
+            if (command == "runs"):
+                await self.send('Runs: ' + json.dumps(RUN_STORE.runs(limit=10)))
+
+            if (command == "sensor measure"):
+                WebSocketHandler.sensor.measure()
+
+            if (command == "sensor"):
+                await self.send('Sensor: ' + json.dumps({'mode': WebSocketHandler.sensor.mode,
+                                                         'latency': WebSocketHandler.sensor.latency()}))
+
+            if (command == "profile start"):
+                PROFILER.start(duration=PROFILE_MAX_SECONDS)
+                await self.send(PROFILER.summary())
+
+            if (command == "profile stop"):
+                await tornado.ioloop.IOLoop.current().run_in_executor(None, PROFILER.stop)
+                await self.send(PROFILER.summary())
+
+            if (command == "profile"):
+                await self.send(PROFILER.summary())
 
     def on_close(self):
         '''
         Called when the WebSocket connection is closed
         '''
         logger.info("Connection closed")
-        if self.sid is not None:
-            WebSocketHandler.robot.removeWebsocket(self.rid)
-            WebSocketHandler.robot.removeWebsocket(self.sid)
+        WebSocketHandler.robot.removeWebsocket(self)
+        WebSocketHandler.sensor.removeWebsocket(self)
+
+    async def gpio(self, func, *args):
+        '''
+        Run a blocking GPIO call in the GPIO executor, without blocking the event loop.
+        '''
+        return await tornado.ioloop.IOLoop.current().run_in_executor(GPIO_EXECUTOR, func, *args)
+
+    async def send(self, message):
+        '''
+        Send a message to the client, and wait until it has been written.
+
+        Messages are dropped while the client has MAX_PENDING messages
+        waiting, so that a slow client does not make the server buffer
+        without bounds.
+        '''
+        if self.pending >= MAX_PENDING:
+            logger.debug("Client is behind, dropping message: " + message)
+            return
+        self.pending += 1
+        try:
+            await self.write_message(message)
+        except tornado.websocket.WebSocketClosedError:
+            pass
+        finally:
+            self.pending -= 1
 
     def event_light(self):
         '''
@@ -128,6 +367,7 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
 
         if self.running:
             WebSocketHandler.robot.forward(25, 50)
+            self.check_line()
 
     def event_dark(self):
         '''
@@ -141,12 +381,35 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         
         if self.running:
             WebSocketHandler.robot.forward(50, 25)
+            self.check_line()
+
+    def check_line(self):
+        '''
+        Record a line loss, if it has been too long since the last sensor edge.
+
+        Called on each sensor edge, and when the run stops, so that a line
+        that is never found again is counted too.
+        '''
+        now = time.time()
+        if WebSocketHandler.last_edge is not None:
+            lost = now - WebSocketHandler.last_edge
+            if lost > LINE_LOSS_TIME:
+                logger.debug("Line was lost for " + str(lost) + " seconds")
+                RUN_STORE.record(LINE_LOST, lost, when=WebSocketHandler.last_edge)
+        WebSocketHandler.last_edge = now
             
     def event_run(self):
         '''
-        Start the line following routines.
+        Start the line following routines, or mark a lap if they are running.
         '''
         logger.debug("Start button pressed")
+        if WebSocketHandler.running:
+            lap_time = RUN_STORE.lap()
+            if lap_time is not None:
+                broadcast.broadcast(WebSocketHandler.robot.websocket, 'Lap: ' + "%.3f" % lap_time)
+            return
+        RUN_STORE.start()
+        WebSocketHandler.last_edge = time.time()
         WebSocketHandler.running = True;
 
     def event_stop(self):
@@ -154,19 +417,39 @@ class WebSocketHandler(tornado.websocket.WebSocketHandler):
         Stop the line following routines.
         '''
         logger.debug("Stop button pressed")
+        if WebSocketHandler.running:
+            self.check_line()
         WebSocketHandler.running = False;
+        WebSocketHandler.last_edge = None
+        # Tell the frontend how the run went.
+        summary = RUN_STORE.stop()
+        if summary is not None:
+            broadcast.broadcast(WebSocketHandler.robot.websocket, 'Run: ' + json.dumps(summary))
 
 
-# Instantiate the Tornado application.
-APP = tornado.web.Application(handlers=[(r"/", IndexHandler),
-                                        (r"/ws", WebSocketHandler)],
-                                      autoreload=True)
-
+def make_app():
+    '''
+    Instantiate the Tornado application.
 
-def main():
+    This is done from inside the event loop, so that autoreload uses the same loop.
+    '''
+    return tornado.web.Application(handlers=[(r"/", IndexHandler),
+                                             (r"/ws", WebSocketHandler),
+                                             (r"/profile", ProfileHandler),
+                                             (r"/runs", RunsHandler),
+                                             (r"/runs/([0-9]+)", RunsHandler)],
+                                   static_path=STATIC_PATH,
+                                   static_handler_class=StaticHandler,
+                                   compress_response=True,
+                                   autoreload=True)
+
+
+async def main():
     '''
     Main entry point, start the server.
     '''
+    global RUN_STORE
+
     # Tell Tornado to parse the command line for us.
     tornado.options.parse_command_line()
 
@@ -190,17 +473,34 @@ def main():
     # Intital setup of the Raspberry Pi.
     # GPIO.setwarnings(False)
     GPIO.setmode(GPIO.BCM)
+    # Calibrate the light sensor before taking any connections.
+    init_sensor()
+
+    # Open the run analytics.
+    RUN_STORE = RunStore()
+
+    # Compress the web frontend assets once, instead of on each request.
+    precompress()
+
+    # Name the event loop thread in the profiles.
+    PROFILER.names[threading.get_ident()] = "ioloop"
+
+    # Messages from the GPIO thread are sent from this event loop.
+    broadcast.init(tornado.ioloop.IOLoop.current())
 
     # Create a Tornado HTTP and WebSocket server.
-    http_server = tornado.httpserver.HTTPServer(APP)
+    http_server = tornado.httpserver.HTTPServer(make_app())
     http_server.listen(options.port)
     logger.info("Listening on port: " + str(options.port))
 
-    # Start the Tornado event loop.
-    tornado.ioloop.IOLoop.instance().start()
-
-    # Close the log if we're done.
-    close_log()
+    # Serve until the program is stopped.
+    await asyncio.Event().wait()
 
 if __name__ == "__main__":
-    main()
+    try:
+        asyncio.run(main())
+    finally:
+        if RUN_STORE is not None:
+            RUN_STORE.close()
+        # Close the log if we're done.
+        close_log()
@@ -0,0 +1,51 @@
+//Create WebSocket address from http uri.
+var loc = window.location
+var ws_uri;
+if (loc.protocol === "https:")
+{
+	ws_uri = "wss:";
+}
+else
+{
+	ws_uri = "ws:";
+}
+ws_uri += "//" + loc.host + "/ws";
+var ws = new WebSocket(ws_uri);
+
+// Tell us that we are connected
+ws.onopen = function()
+{
+	$("#con_stat").html("Connected");
+	$("#con_stat").removeClass('alert-info');
+	$("#con_stat").addClass('alert-success');
+};
+
+// Tell us that the connection has closed.
+ws.onclose = function()
+{
+	$("#con_stat").html("Connection closed");
+	$("#con_stat").removeClass('alert-success');
+	$("#con_stat").addClass('alert-info');
+};
+
+// Process any LED status change massages
+ws.onmessage = function(event)
+{
+	$("#con_stat").html("Message: " + event.data);
+	$("#msg").append(event.data + "\n");
+	$("#con_stat").removeClass('alert-info');
+	$("#con_stat").addClass('alert-success');
+};
+
+function do_click(action)
+{
+	$("#con_stat").html("Send: " + action);
+	$("#con_stat").removeClass('alert-info');
+	$("#con_stat").addClass('alert-success');
+	ws.send(action);
+}
+
+function stop()
+{
+	do_click('stop')
+}
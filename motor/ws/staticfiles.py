@@ -0,0 +1,18 @@
+'''
+Where the static assets of the web frontend are, and which are compressed.
+
+Kept apart from the assets module, so that tools like bench_wire.py can use
+it without importing log, which rotates the log file.
+'''
+import os
+
+
+STATIC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+'''
+Directory of the static assets.
+'''
+
+COMPRESSIBLE = ('.css', '.js', '.html', '.svg', '.json', '.txt')
+'''
+File extensions that are worth compressing.
+'''
@@ -1,6 +1,7 @@
 import RPi.GPIO as GPIO
 
 from log import logger
+from broadcast import broadcast
 
 
 class T9(object):
@@ -43,25 +44,24 @@ class T9(object):
 
     def addWebsocket(self, ws):
         '''
-        Add a WebSocket connection and return its index.
-        
+        Add a WebSocket connection to the list of receivers.
+
         :param ws: WebSocket connection.
         :type ws: tornado.websocket.WebSocketHandler
         '''
-        # Add the new websocker to the list of receivers.
         T9.websocket.append(ws)
         logger.debug("Added connection number " + str(len(T9.websocket)))
-        # Return the position in the list of the new receiver.
-        return(len(T9.websocket) - 1)
 
-    def removeWebsocket(self, index):
+    def removeWebsocket(self, ws):
         '''
-        Remove a WebSocket connection front the list of receivers
-        
-        :param index: The index of the WebSocket to remove.
+        Remove a WebSocket connection from the list of receivers.
+
+        :param ws: WebSocket connection.
+        :type ws: tornado.websocket.WebSocketHandler
         '''
-        del T9.websocket[index]
-        logger.debug("Removed connection number " + str(index))
+        if ws in T9.websocket:
+            T9.websocket.remove(ws)
+            logger.debug("Removed connection, " + str(len(T9.websocket)) + " left")
 
     def forward(self, lspeed=100, rspeed=75):
         '''
@@ -71,8 +71,7 @@ class T9(object):
         :param lspeed: The speed to apply to the right motor.
         '''
         # Tell the connected clients what we're about to do
-        for connection in T9.websocket:
-            connection.write_message('Forward: ' + str(lspeed) + ', ' + str(rspeed))
+        broadcast(T9.websocket, 'Forward: ' + str(lspeed) + ', ' + str(rspeed))
         # Set both motors to forward direction.
         GPIO.output(self.ld1, 1)
         GPIO.output(self.rd1, 1)
@@ -90,8 +89,7 @@ class T9(object):
         :param lspeed: The speed to apply to the right motor.
         '''
         # Tell the connected clients what we're about to do
-        for connection in T9.websocket:
-            connection.write_message('Reverse: ' + str(lspeed) + ', ' + str(rspeed))
+        broadcast(T9.websocket, 'Reverse: ' + str(lspeed) + ', ' + str(rspeed))
         # Set the direction of the motor to backwards
         GPIO.output(self.ld1, 0)
         GPIO.output(self.rd1, 0)
@@ -103,8 +101,7 @@ class T9(object):
 
     def stop(self):
         # Tell the connected clients what we're about to do
-        for connection in T9.websocket:
-            connection.write_message('Stop')
+        broadcast(T9.websocket, 'Stop')
         # Set all directional outputs to off
         GPIO.output(self.ld1, 0)
         GPIO.output(self.rd1, 0)